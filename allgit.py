@@ -28,15 +28,18 @@ def main(args=sys.argv, env=os.environ):
     reruns_default = int(env.get("ALLGIT_RERUNS", 0))
     wait_default = float(env.get("ALLGIT_WAIT", 0.0))
     mine, delim, cmd = split_args(args[1:], delims=("-", "--"))
-    if cmd and delim == "-" and cmd[0] != git_tool:  # Git command must be separated by '-'...
-        cmd[0:0] = [git_tool]  # ...and may omit "git" which feels redundant on the command line
-    # Non-git command must be separated by '--', but doesn't get anything magically added
+    cmds = split_steps(cmd, delim, git_tool) if cmd else []
+    if not all(cmds):
+        empty = cmds.index([])
+        where = "before the first '--then'" if empty == 0 else f"after '--then' number {empty}"
+        return f"Error: no command {where}; '--then' separates commands and can't be used as a command argument (see '{_name} -h')"
 
     usage = f"""                                                      v{_version}
     \t{_name} [DIR ...] [options] [- [{git_tool}] SUBCOMMAND]
     \t{_name} [DIR ...] [options] [-- ANY COMMAND]
+    \t{_name} [DIR ...] [options] [- [{git_tool}] SUBCOMMAND | -- ANY COMMAND] [--then [- | --] NEXT COMMAND ...]
     \t{_name} -h/--help"""
-    description = f"""Run a {git_tool} command in all repositories in the current directory (or those specified); can also run other scripts or commands.
+    description = f"""Run a {git_tool} command in all repositories in the current directory (or those specified); can also run other scripts or commands.  Several commands can be run in one pass by separating them with '--then'; each repository runs them in order and skips the rest if one fails.  Note that '--then' is reserved and always splits the command, even where it was meant as an argument; wrap such commands in a script.
     """
     epilog = """Allgit makes working with many git repositories easier, especially keeping them all up-to-date, managing branches between them, and making changes across multiple projects.  Example workflow and more in the accompanying README.md or online: https://github.com/inventhouse/allgit
     """
@@ -66,7 +69,12 @@ def main(args=sys.argv, env=os.environ):
     search_group.add_argument(
         "-s", "--subrepos",
         action="store_true",
-        help="Search git repositories for repositories cloned as subdirectories.",
+        help="Search git repositories for repositories cloned as subdirectories and checked-out submodules; ignored directories that are not repositories themselves (such as build outputs) are skipped.",
+    )
+    search_group.add_argument(
+        "--exhaustive",
+        action="store_true",
+        help="Search every directory for sub-repositories, even ignored directories (by .gitignore, .git/info/exclude, or global excludes) that are not repositories themselves.",
     )
     search_group.add_argument(
         "-i", "--include",
@@ -186,15 +194,15 @@ def main(args=sys.argv, env=os.environ):
 
     found_repos = []
     for d in my_args.dirs:
-        found_repos.extend(find_repos(d, depth=my_args.depth, subrepos=my_args.subrepos))
+        found_repos.extend(find_repos(d, depth=my_args.depth, subrepos=my_args.subrepos, prune=not my_args.exhaustive))
 
     include_repos = []
     for d in my_args.include:
-        include_repos.extend(find_repos(d, depth=my_args.depth, subrepos=my_args.subrepos))
+        include_repos.extend(find_repos(d, depth=my_args.depth, subrepos=my_args.subrepos, prune=not my_args.exhaustive))
 
     exclude_repos = []
     for d in my_args.exclude:
-        exclude_repos.extend(find_repos(d, depth=my_args.depth, subrepos=my_args.subrepos))
+        exclude_repos.extend(find_repos(d, depth=my_args.depth, subrepos=my_args.subrepos, prune=not my_args.exhaustive))
 
     normalize_paths(found_repos, include_repos, exclude_repos)
     repos = [ r for r in found_repos if r not in exclude_repos ]
@@ -207,7 +215,7 @@ def main(args=sys.argv, env=os.environ):
         repos = [ r for r in repos if repo_branches(r, my_args.branches) ]  # Pre-filter for repos with the branches (process_repo will end up re-checking the branches, but that's pretty quick and I don't see a clean way to avoid that)
 
     if my_args.print_args:
-        print(f"* Args:\n\t{my_args}\n* Command:\n\t{cmd}")
+        print(f"* Args:\n\t{my_args}\n* Commands:\n\t{cmds}")
         print(f"* Found Repos:\n\t{found_repos}")
         if exclude_repos:
             print(f"* Excluded Repos:\n\t{exclude_repos}")
@@ -223,8 +231,8 @@ def main(args=sys.argv, env=os.environ):
         return f"Error: found {len(set(found_repos + include_repos))} repositories but all were filtered out"  # REM: error seems harsh for things like -m which might legitimately filter all repos
 
     xit = 0
-    if cmd or my_args.clone_script or my_args.fetch or (my_args.branches and my_args.checkout) or my_args.list:  # Only call run if there's something to do
-        xit = repo_loop(repos, cmd=cmd, fetch=my_args.fetch, test_cmd=my_args.test, branches=my_args.branches, checkout=my_args.checkout, dry_run=my_args.dry_run, include_repos=clean_include_repos, script_out=my_args.clone_script, print_list=my_args.list, retries=my_args.retries, retry_backoff=my_args.retry_backoff, wait=my_args.wait, reruns=my_args.reruns)
+    if cmds or my_args.clone_script or my_args.fetch or (my_args.branches and my_args.checkout) or my_args.list:  # Only call run if there's something to do
+        xit = repo_loop(repos, cmds=cmds, fetch=my_args.fetch, test_cmd=my_args.test, branches=my_args.branches, checkout=my_args.checkout, dry_run=my_args.dry_run, include_repos=clean_include_repos, script_out=my_args.clone_script, print_list=my_args.list, retries=my_args.retries, retry_backoff=my_args.retry_backoff, wait=my_args.wait, reruns=my_args.reruns)
 
     if not my_args.list:
         print(f"{tput('bold')}Done.{tput('sgr0')}")
@@ -243,16 +251,31 @@ def split_args(args, delims=("--",)):
     return (before, indexes[i], after)
 
 
-def repo_loop(repos, cmd=None, fetch=False, test_cmd=None, branches=None, checkout=False, dry_run=False, include_repos=[], script_out=None, print_list=False, retries=3, retry_backoff=10.0, wait=0.0, reruns=3):
+def split_steps(cmd, delim, git_tool, then="--then"):
+    "Splits a command on 'then' separators into a list of step commands; a step after the first may start with its own '-' or '--' separator, otherwise it is the same kind as the step before it."
+    steps = []
+    while cmd is not None:
+        step, _, cmd = split_args(cmd, delims=(then,))
+        if steps and step and step[0] in ("-", "--"):  # The first step's separator was already split off; anything left is part of the command
+            delim = step.pop(0)
+        if step and delim == "-" and step[0] != git_tool:  # Git command must be separated by '-'...
+            step[0:0] = [git_tool]  # ...and may omit "git" which feels redundant on the command line
+        # Non-git command must be separated by '--', but doesn't get anything magically added
+        steps.append(step)
+    return steps
+
+
+def repo_loop(repos, cmds=None, fetch=False, test_cmd=None, branches=None, checkout=False, dry_run=False, include_repos=[], script_out=None, print_list=False, retries=3, retry_backoff=10.0, wait=0.0, reruns=3):
     "Run the commands in the repos, also handle clone script and errors."
     # FIXME: Somewhat better, but still twisty
     script_lines = []
     did_repos = []
     errors = {}  # {repo: [(command, error), ...], ...}
+    steps_done = {}  # {repo: n, ...} so reruns pick up at the step that failed
     first_print = True
     def print_header(r):
         nonlocal first_print
-        if fetch or checkout or cmd:  # Only print if doing something 'interesting'; skip printing if just generating clone_script
+        if fetch or checkout or cmds:  # Only print if doing something 'interesting'; skip printing if just generating clone_script
             if not first_print:
                 print("")  # Add a blank between repos if looping multiple times
             print(f"{tput('bold')}------  {r}  ------{tput('sgr0')}")
@@ -267,7 +290,7 @@ def repo_loop(repos, cmd=None, fetch=False, test_cmd=None, branches=None, checko
             time.sleep(wait)
         seen_repos.add(r)
         print_header(r)
-        did = process_repo(r, errors, cmd=cmd, fetch=fetch, test_cmd=test_cmd, branches=branches, checkout=checkout, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
+        did = process_repo(r, errors, cmds=cmds, steps_done=steps_done, fetch=fetch, test_cmd=test_cmd, branches=branches, checkout=checkout, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
         if did and script_out:
             script_lines.append(clone_script_line(r))
         if did and print_list:
@@ -281,7 +304,7 @@ def repo_loop(repos, cmd=None, fetch=False, test_cmd=None, branches=None, checko
             time.sleep(wait)
         seen_repos.add(r)
         print_header(r)
-        did = process_repo(r, errors, cmd=cmd, fetch=fetch, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)  # "Included" repos are not subject to branch checks so omit branches and checkout (the latter doesn't apply if no branches are requested)
+        did = process_repo(r, errors, cmds=cmds, steps_done=steps_done, fetch=fetch, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)  # "Included" repos are not subject to branch checks so omit branches and checkout (the latter doesn't apply if no branches are requested)
         if did and script_out:
             script_lines.append(clone_script_line(r))
         if did and print_list:
@@ -295,23 +318,27 @@ def repo_loop(repos, cmd=None, fetch=False, test_cmd=None, branches=None, checko
         n_failed = len(failed_repos) + len(failed_include_repos)
         print(f"\n{tput('bold')}--- Rerun {rerun + 1}/{reruns}: {n_failed} failed {'repo' if n_failed == 1 else 'repos'} ---{tput('sgr0')}", file=sys.stderr)
         for r in failed_repos:
-            del errors[r]
+            prev_errors = errors.pop(r)
             if wait and seen_repos:
                 print(f"Wait {wait}s...", file=sys.stderr)
                 time.sleep(wait)
             print_header(r)
-            did = process_repo(r, errors, cmd=cmd, fetch=fetch, test_cmd=test_cmd, branches=branches, checkout=checkout, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
+            did = process_repo(r, errors, cmds=cmds, steps_done=steps_done, fetch=fetch, test_cmd=test_cmd, branches=branches, checkout=checkout, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
+            if not did and r not in errors:
+                errors[r] = prev_errors  # Skipped without a new error (eg branches now missing), so it still failed
             if did and script_out:
                 script_lines.append(clone_script_line(r))
             if did and print_list:
                 did_repos.append(r)
         for r in failed_include_repos:
-            del errors[r]
+            prev_errors = errors.pop(r)
             if wait and seen_repos:
                 print(f"Wait {wait}s...", file=sys.stderr)
                 time.sleep(wait)
             print_header(r)
-            did = process_repo(r, errors, cmd=cmd, fetch=fetch, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
+            did = process_repo(r, errors, cmds=cmds, steps_done=steps_done, fetch=fetch, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
+            if not did and r not in errors:
+                errors[r] = prev_errors  # Skipped without a new error (eg branches now missing), so it still failed
             if did and script_out:
                 script_lines.append(clone_script_line(r))
             if did and print_list:
@@ -353,17 +380,20 @@ def repo_loop(repos, cmd=None, fetch=False, test_cmd=None, branches=None, checko
     return xit
 
 
-def process_repo(repo, errors, cmd=None, fetch=False, test_cmd=None, branches=None, checkout=False, dry_run=False, retries=3, retry_backoff=10.0):
-    "Run commands in a repo, including optional fetch, branch-check, and checkout; also print commands when appropreate."
+def process_repo(repo, errors, cmds=None, steps_done=None, fetch=False, test_cmd=None, branches=None, checkout=False, dry_run=False, retries=3, retry_backoff=10.0):
+    "Run commands in a repo, including optional fetch, branch-check, and checkout; also print commands when appropreate.  User command steps run in order, stopping at the first failure; if a steps_done dictionary is given, steps already done in this repo are skipped, along with the test and checkout that came before them."
     # FIXME: Somewhat better, but still twisty
-    print_cmd = (fetch or test_cmd or checkout)  # Print "active" commands if running more than just the user command
+    cmds = cmds or []
+    start = steps_done.get(repo, 0) if steps_done is not None else 0
+    resuming = start > 0  # Earlier steps may have changed the state the test and checkout were for (eg checked out a new branch)
+    print_cmd = (fetch or test_cmd or checkout or len(cmds) > 1)  # Print "active" commands if running more than just the user command
     if fetch:
         fetch_cmd = ["git", "fetch"]
         ok = repo_run(repo, fetch_cmd, errors=errors, print_cmd=print_cmd, retries=retries, retry_backoff=retry_backoff)
         if not ok:
             return False
 
-    if test_cmd:
+    if test_cmd and not resuming:
         ok = repo_run(repo, test_cmd, print_cmd=print_cmd)  # Don't collect test failures
         if not ok:
             print("Skipping")
@@ -378,20 +408,25 @@ def process_repo(repo, errors, cmd=None, fetch=False, test_cmd=None, branches=No
     if fetch and found_branches:  # Only print if branches might be newly-found
         print(f"Found branches: {', '.join(found_branches)}")
 
-    if checkout and found_branches:
+    if checkout and found_branches and not resuming:
         checkout_cmd = ["git", "checkout", found_branches[0]]
         ok = repo_run(repo, checkout_cmd, errors=errors, print_cmd=print_cmd, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
         if not ok:
             return False
 
-    if cmd:
-        env = None
-        if found_branches:  # Make requested branch available to the command
-            env = dict(os.environ)
-            env["ALLGIT_BRANCH"] = found_branches[0]
-        ok = repo_run(repo, cmd, env=env, errors=errors, print_cmd=print_cmd, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
+    env = None
+    if cmds and found_branches:  # Make requested branch available to the commands
+        env = dict(os.environ)
+        env["ALLGIT_BRANCH"] = found_branches[0]
+    for i in range(start, len(cmds)):
+        ok = repo_run(repo, cmds[i], env=env, errors=errors, print_cmd=print_cmd, dry_run=dry_run, retries=retries, retry_backoff=retry_backoff)
         if not ok:
+            if i + 1 < len(cmds):
+                n_skip = len(cmds) - i - 1
+                print(f"Skipping {n_skip} remaining {'step' if n_skip == 1 else 'steps'}")
             return False
+        if steps_done is not None:
+            steps_done[repo] = i + 1
 
     return True
 
@@ -463,13 +498,16 @@ def space_quote(s):
 
 
 ###  Repos  ###
-def find_repos(root, depth=1, subrepos=False):
-    "Find repos in a directory, limited to 'depth' levels."
+def find_repos(root, depth=1, subrepos=False, prune=True):
+    "Find repos in a directory, limited to 'depth' levels; when searching for subrepos, checked-out submodules are found too and ignored directories that aren't repos themselves are skipped unless 'prune' is False."
     start_depth = len(PurePath(root).parts)
     repos = []
+    pruned = set()  # Normalized paths of ignored directories that can't hold subrepos we care about
+    submodules = set()  # Normalized paths of submodules listed in .gitmodules of repos we've searched
     for current, dirs, files in os.walk(root):  # TODO: Maybe 'in/exclude' pattern option?
         is_bare_repo = repo_is_bare(current)
-        if is_bare_repo or ".git" in dirs:
+        is_work_tree = ".git" in dirs or (".git" in files and os.path.normpath(current) in submodules)  # Checked-out submodules have a .git file instead of a directory
+        if is_bare_repo or is_work_tree:
             repos.append(os.path.normpath(current))
             dirs[:] = [ d for d in dirs if subrepos and not is_bare_repo and d != ".git" ]  # If searching for subrepos, don't search bare repos or .git
 
@@ -477,6 +515,15 @@ def find_repos(root, depth=1, subrepos=False):
         if depth >= 0 and current_depth - start_depth >= depth:
             dirs[:] = []  # Don't descend any deeper
 
+        if is_work_tree and dirs:  # Only ask git when we're about to search inside a working tree
+            submodules.update(os.path.normpath(os.path.join(current, s)) for s in repo_submodules(current))
+            if prune:
+                ignored = [ os.path.normpath(os.path.join(current, i)) for i in repo_ignored_dirs(current) ]
+                pruned.update(i for i in ignored if not (repo_is_bare(i) or os.path.lexists(os.path.join(i, ".git"))))  # Subrepos are often cloned into ignored directories, keep those
+                pruned -= submodules  # Never skip submodules, even if they also match an ignore pattern
+        if pruned:
+            dirs[:] = [ d for d in dirs if os.path.normpath(os.path.join(current, d)) not in pruned ]
+
     return sorted(repos)
 
 
@@ -537,6 +584,26 @@ def repo_remote_url(repo, remote="origin"):
     return lines[0] if lines else None
 
 
+def repo_ignored_dirs(repo):
+    "Returns the list of directories in a git working tree that are ignored by .gitignore, .git/info/exclude, or global excludes; git reports the top-most ignored directory without descending into it.  Returns an empty list if git can't tell us."
+    ignored_cmd = ["git", "ls-files", "--others", "--ignored", "--exclude-standard", "--directory", "-z"]
+    result = sub.run(ignored_cmd, cwd=repo, stdout=sub.PIPE, stderr=sub.DEVNULL)
+    if result.returncode != 0:
+        return []  # Fall back to searching everything
+    entries = os.fsdecode(result.stdout).split("\0")  # Paths may not be valid UTF-8, decode them the same way os.walk does
+    return [ e.rstrip("/") for e in entries if e.endswith("/") ]  # Directories are reported with a trailing slash
+
+
+def repo_submodules(repo):
+    "Returns the list of submodule paths listed in a git working tree's .gitmodules."
+    if not os.path.isfile(os.path.join(repo, ".gitmodules")):
+        return []
+    submodules_cmd = ["git", "config", "--file", ".gitmodules", "--get-regexp", r"^submodule\..*\.path$"]
+    result = sub.run(submodules_cmd, cwd=repo, stdout=sub.PIPE, stderr=sub.DEVNULL)
+    lines = [ os.fsdecode(s) for s in result.stdout.splitlines() ]
+    return [ l.split(" ", 1)[1] for l in lines if " " in l ]  # 'submodule.NAME.path PATH'
+
+
 def repo_is_bare(repo):
     "Checks if a directory is a bare git repository."
     return repo.endswith(".git")  # FIXME: maybe a better heuristic? r/HEAD exists or somesuch?